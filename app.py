@@ -1,7 +1,9 @@
 import os
 import re
 import io
-import base64
+import hashlib
+import threading
+import unicodedata
 import numpy as np
 import pandas as pd
 import matplotlib
@@ -9,8 +11,9 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 
-from difflib import SequenceMatcher
-from flask import Flask, request, jsonify
+from functools import lru_cache
+from flask import Flask, Response, abort, request, jsonify, url_for
+from rapidfuzz import process, fuzz
 
 ##################
 # Flask App
@@ -25,8 +28,8 @@ if os.path.exists(local_font_path):
     try:
         # font_managerを使って fontProp 作成
         font_prop = fm.FontProperties(fname=local_font_path)
-        # キャッシュ再構築
-        fm._rebuild()
+        # システム全体のキャッシュを再構築せず、このフォントだけを登録する
+        fm.fontManager.addfont(local_font_path)
         # rcParams にセット
         plt.rcParams["font.family"] = font_prop.get_name()
         print("Using local font:", font_prop.get_name())
@@ -53,58 +56,68 @@ else:
     })
     print("CSV not found, using demo data.")
 
+# 回答はどの列も少数の選択肢なので category 型にする (value_counts や比較が整数コードで済む)
+for c in df.select_dtypes(include="object").columns:
+    df[c] = df[c].astype("category")
+
 print("CSV columns:", df.columns.tolist())
 
 ##################
 # 3) 稼働日数の数値化
 ##################
-def parse_kadou_nissu(s):
-    if not isinstance(s, str):
-        return None
-    m_le = re.match(r"(\d+)日以下", s)
-    if m_le:
-        return float(m_le.group(1))
-    m_range = re.match(r"(\d+)～(\d+)日", s)
-    if m_range:
-        start = float(m_range.group(1))
-        end = float(m_range.group(2))
-        return (start + end)/2
-    m_single = re.match(r"(\d+)日", s)
-    if m_single:
-        return float(m_single.group(1))
-    return None
+def parse_kadou_nissu(s: pd.Series) -> pd.Series:
+    """
+    「2日以下」->2, 「3～4日」->3.5, 「5日」->5 を列全体でまとめて数値化。
+    行ごとの apply ではなく str.extract 1回で処理する。
+    """
+    ext = s.astype("string").str.extract(r"^(\d+)(?:～(\d+))?日")
+    start = ext[0].astype(float)
+    end = ext[1].astype(float)
+    return start.where(end.isna(), (start + end) / 2)
 
 if "稼働日数" in df.columns:
-    df["稼働日数_num"] = df["稼働日数"].apply(parse_kadou_nissu)
+    df["稼働日数_num"] = parse_kadou_nissu(df["稼働日数"])
 
 ##################
 # 4) ファジーマッチ
 ##################
-def normalize_str(s: str) -> str:
-    s = s.lower()
-    s = re.sub(r"[()\s（）]", "", s)
-    return s
-
-def calc_similarity(a: str, b: str) -> float:
-    return SequenceMatcher(None, normalize_str(a), normalize_str(b)).ratio()
+# 括弧と空白 (\s と同じく全角スペース等の Unicode 空白を含む) を削除する変換表
+NORMALIZE_DROP = str.maketrans("", "", "()（）" + "".join(
+    ch for ch in map(chr, range(0x3001)) if ch.isspace()
+))
 
+def normalize_str(s: str) -> str:
+    # NFKC で全角英数・全角括弧を半角に寄せてから、正規表現を使わず translate で除去
+    return unicodedata.normalize("NFKC", s).lower().translate(NORMALIZE_DROP)
+
+# 列名の正規化は起動時に1回だけ (df.columns と同じ並び)
+NORMALIZED_COLS = [normalize_str(c) for c in df.columns]
+# 正規化後の列名そのものが来た場合はファジーマッチせず辞書引きで返す
+EXACT_COLS = {}
+for n, c in zip(NORMALIZED_COLS, df.columns):
+    EXACT_COLS.setdefault(n, c)
+
+# 列名は起動後に変わらないので、同じトークンの判定結果はキャッシュする
+@lru_cache(maxsize=1024)
 def find_best_column(user_text: str, threshold=0.5):
     """
     threshold=0.5 に設定。
     「あ」 -> 類似度が低すぎ -> None
     「荷台形状」 -> ある程度合致。
+    類似度計算は rapidfuzz (C++実装) で全列を1回の呼び出しで評価する。
     """
-    best_score = 0.0
-    best_col = None
-    for col in df.columns:
-        score = calc_similarity(user_text, col)
-        if score > best_score:
-            best_score = score
-            best_col = col
-    # print(f"[DEBUG] {user_text} -> best:{best_col} score:{best_score}")
-    if best_score < threshold:
+    norm = normalize_str(user_text)
+    if norm in EXACT_COLS:
+        return EXACT_COLS[norm]
+
+    hit = process.extractOne(
+        norm, NORMALIZED_COLS,
+        scorer=fuzz.ratio, score_cutoff=threshold * 100
+    )
+    # print(f"[DEBUG] {user_text} -> {hit}")
+    if hit is None:
         return None
-    return best_col
+    return df.columns[hit[2]]
 
 ##################
 # 5) ガイドメッセージ
@@ -127,19 +140,27 @@ def get_guide_message():
 ##################
 # 6) 条件解析
 ##################
+# 正規表現は呼び出し毎ではなく起動時に1回だけコンパイル
+RE_JOSHI = re.compile(r"[のでをにはが]")
+RE_SPACES = re.compile(r"\s+")
+# 「N日以上」「N日以下」「N日」を1回の search で判定し、接尾辞から演算子を引く
+RE_DAYS_COND = re.compile(r"(\d+)日(以上|以下)?")
+DAYS_OPS = {"以上": ">=", "以下": "<=", None: "=="}
+RE_NUMBER = re.compile(r"(\d+)")
+
+def preprocess_question(user_text: str) -> str:
+    """助詞を空白に置き換え、空白を1つにまとめる (何度かけても結果は同じ)。"""
+    user_text = user_text.replace("のグラフ", "")
+    user_text = RE_JOSHI.sub(" ", user_text)
+    return RE_SPACES.sub(" ", user_text).strip()
+
 def parse_conditions(user_text: str):
     # 助詞除去
-    user_text = user_text.replace("のグラフ", "")
-    user_text = re.sub(r"[のでをにはが]", " ", user_text)
-    user_text = re.sub(r"\s+", " ", user_text).strip()
+    user_text = preprocess_question(user_text)
 
     filter_dict = {}
     target_col = None
 
-    pat_ge = re.compile(r"(\d+)日以上")
-    pat_le = re.compile(r"(\d+)日以下")
-    pat_eq = re.compile(r"(\d+)日")
-
     tokens = user_text.split()
     col_in_focus = None
 
@@ -150,26 +171,14 @@ def parse_conditions(user_text: str):
             continue
 
         if col_in_focus:
-            m_ge = pat_ge.search(t)
-            m_le = pat_le.search(t)
-            m_eq_ = pat_eq.search(t)
-
-            if m_ge:
-                val = m_ge.group(1) + "日"
-                filter_dict[col_in_focus] = (">=", val)
-                col_in_focus = None
-            elif m_le:
-                val = m_le.group(1) + "日"
-                filter_dict[col_in_focus] = ("<=", val)
-                col_in_focus = None
-            elif m_eq_:
-                val = m_eq_.group(1) + "日"
-                filter_dict[col_in_focus] = ("==", val)
-                col_in_focus = None
+            m = RE_DAYS_COND.search(t)
+            if m:
+                val = m.group(1) + "日"
+                filter_dict[col_in_focus] = (DAYS_OPS[m.group(2)], val)
             else:
                 # 文字
                 filter_dict[col_in_focus] = ("==", t)
-                col_in_focus = None
+            col_in_focus = None
 
     # 文末付近でターゲット列を探す
     for t in reversed(tokens):
@@ -187,38 +196,67 @@ def parse_conditions(user_text: str):
 # 7) フィルタ適用
 ##################
 def apply_filters(df_in: pd.DataFrame, filter_dict: dict):
-    filtered = df_in.copy()
+    # 条件ごとに DataFrame を作り直さず、bool マスクを AND で積み上げて最後に1回だけ抽出
+    mask = np.ones(len(df_in), dtype=bool)
+
+    # 安い数値比較 (稼働日数) を先に評価し、文字列の部分一致は残った行だけに行う
+    conditions = sorted(filter_dict.items(), key=lambda item: item[0] != "稼働日数")
 
-    for col, (op, val) in filter_dict.items():
-        if col not in filtered.columns:
+    for col, (op, val) in conditions:
+        if col not in df_in.columns:
             continue
+        if not mask.any():
+            break
 
-        if col == "稼働日数" and "稼働日数_num" in filtered.columns:
+        if col == "稼働日数" and "稼働日数_num" in df_in.columns:
             # 数値比較
-            m_num = re.search(r"(\d+)", val)
+            m_num = RE_NUMBER.search(val)
             if m_num:
                 v = float(m_num.group(1))
+                arr = df_in["稼働日数_num"].to_numpy()
                 if op == ">=":
-                    filtered = filtered[filtered["稼働日数_num"] >= v]
+                    mask &= arr >= v
                 elif op == "<=":
-                    filtered = filtered[filtered["稼働日数_num"] <= v]
+                    mask &= arr <= v
                 elif op == "==":
-                    filtered = filtered[filtered["稼働日数_num"] == v]
+                    mask &= arr == v
         else:
-            # 文字列部分一致
-            if op == "==":
-                filtered = filtered[filtered[col].astype(str).str.contains(val)]
-            elif op == ">=":
-                filtered = filtered[filtered[col].astype(str).str.contains(val)]
-            elif op == "<=":
-                filtered = filtered[filtered[col].astype(str).str.contains(val)]
+            # 文字列部分一致 (==, >=, <= いずれも部分一致扱い)。値は正規表現ではなく文字列として扱う
+            series = df_in[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                # category 型なら数種類の選択肢だけを検索し、行は整数コードの一致で選ぶ
+                cats = series.cat.categories.astype(str)
+                hit_codes = np.flatnonzero(cats.str.contains(val, regex=False))
+                mask &= np.isin(series.cat.codes.to_numpy(), hit_codes)
+            else:
+                rows = np.flatnonzero(mask)
+                mask[rows] = series.iloc[rows].astype(str).str.contains(val, regex=False).to_numpy()
 
-    return filtered
+    return df_in[mask]
 
 ##################
 # 8) グラフ生成
 ##################
-def get_distribution_and_chart(df_in: pd.DataFrame, column_name: str):
+# Figure はリクエスト毎に作らず1枚を使い回す (Agg はスレッドセーフでないのでロックで直列化)
+CHART_FIG, CHART_AX = plt.subplots(figsize=(4,3))
+CHART_LOCK = threading.Lock()
+# 列ごとの余白 (tight_layout の結果)。全データ描画時に1回だけ計算し、絞り込み後の描画では使い回す。
+# 選択肢の列は絞り込んでもラベルが全データの部分集合なので使い回せるが、
+# 数値列は pd.cut が絞り込み後のデータで階級を作り直しラベル幅が変わるので毎回計算する
+CHART_MARGINS = {}
+# 数値列かどうかは列ごとに固定なので起動時に判定しておく (int64 / float32 等も含む)
+NUMERIC_COLS = {c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])}
+
+@lru_cache(maxsize=None)
+def bar_colors(n: int):
+    """棒の本数ごとの配色 (Blues の濃淡) を1回だけ計算して使い回す。"""
+    return plt.cm.Blues(np.linspace(0.3, 0.9, n))
+
+def get_distribution(df_in: pd.DataFrame, column_name: str):
+    """
+    列の分布を集計し (回答テキスト, グラフ用データ or None) を返す。
+    グラフ用データは render_chart にそのまま渡せる (列名, 件数, ラベル)。
+    """
     if column_name not in df_in.columns:
         return f"列 '{column_name}' は存在しません。", None
 
@@ -226,7 +264,7 @@ def get_distribution_and_chart(df_in: pd.DataFrame, column_name: str):
     if len(series) == 0:
         return f"列 '{column_name}' にデータがありません。", None
 
-    if series.dtype in [int, float]:
+    if column_name in NUMERIC_COLS:
         desc = series.describe()
         text_msg = f"【{column_name} の統計】\n"
         text_msg += f"- 件数: {desc['count']}\n"
@@ -237,28 +275,44 @@ def get_distribution_and_chart(df_in: pd.DataFrame, column_name: str):
         labels = [str(interval) for interval in counts.index]
     else:
         counts = series.value_counts()
+        # category 型は絞り込み後に出現しない選択肢も0件で返すので除く
+        counts = counts[counts > 0]
         text_msg = f"【{column_name} の回答分布】\n"
         for idx, val in counts.items():
             text_msg += f"- {idx}: {val} 件\n"
         labels = counts.index.astype(str)
 
-    fig, ax = plt.subplots(figsize=(4,3))
-    colors = plt.cm.Blues(np.linspace(0.3, 0.9, len(counts)))
-    ax.bar(range(len(counts)), counts.values, color=colors, edgecolor="white")
-    ax.set_xticks(range(len(counts)))
-    ax.set_xticklabels(labels, rotation=45, ha="right")
-    ax.set_title(column_name)
-    ax.set_ylabel("件数")
-    ax.grid(axis="y", color="gray", linestyle="--", linewidth=0.5, alpha=0.3)
+    return text_msg, (column_name, counts.values, labels)
+
+def render_chart(column_name: str, values, labels) -> bytes:
+    """棒グラフを描画し、WebP の生バイト列を返す (base64 にはせず /chart ルートでそのまま配信する)。"""
+    with CHART_LOCK:
+        ax = CHART_AX
+        ax.clear()
+        ax.bar(range(len(values)), values, color=bar_colors(len(values)), edgecolor="white")
+        ax.set_xticks(range(len(values)))
+        ax.set_xticklabels(labels, rotation=45, ha="right")
+        ax.set_title(column_name)
+        ax.set_ylabel("件数")
+        ax.grid(axis="y", color="gray", linestyle="--", linewidth=0.5, alpha=0.3)
+
+        margins = CHART_MARGINS.get(column_name)
+        if margins is None:
+            CHART_FIG.tight_layout()
+            if column_name not in NUMERIC_COLS:
+                p = CHART_FIG.subplotpars
+                CHART_MARGINS[column_name] = dict(left=p.left, right=p.right, bottom=p.bottom, top=p.top)
+        else:
+            CHART_FIG.subplots_adjust(**margins)
+        buf = io.BytesIO()
+        # 棒グラフは可逆 WebP の方が PNG より4割ほど小さい。method=0 でエンコード速度優先
+        CHART_FIG.savefig(buf, format="webp", pil_kwargs={"lossless": True, "method": 0})
 
-    plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    chart_b64 = base64.b64encode(buf.read()).decode("utf-8")
-    plt.close(fig)
+    return buf.getvalue()
 
-    return text_msg, chart_b64
+# df は不変なので、フィルタなし (全データ) の分布とグラフは起動時に全列ぶん作っておく
+FULL_DISTRIBUTIONS = {c: get_distribution(df, c) for c in df.columns}
+FULL_CHARTS = {c: render_chart(*data) for c, (_, data) in FULL_DISTRIBUTIONS.items() if data}
 
 ##################
 # 9) Flask ルート
@@ -267,60 +321,111 @@ def get_distribution_and_chart(df_in: pd.DataFrame, column_name: str):
 def index():
     return "Hello from Chat - see /chat"
 
-@app.route("/ask", methods=["POST"])
-def ask():
-    data = request.json
-    user_text = data.get("question", "").strip()
-
+def answer_question(user_text: str):
+    """
+    質問文から (回答テキスト, グラフ用データ or None) を返す。グラフの描画はしない
+    (/ask は画像の有無だけ分かればよく、描画は /chart で1回だけ行う)。
+    """
     # 入力が空
     if not user_text:
-        return jsonify({
-            "answer": "何について知りたいですか？\n" + get_guide_message(),
-            "image": None
-        })
+        return "何について知りたいですか？\n" + get_guide_message(), None
+
+    return answer_conditions(*question_conditions(user_text))
+
+def question_conditions(user_text: str):
+    """質問文を解析し、キャッシュキーに使える (条件のタプル, 集計列) にする。"""
+    # 「荷台形状がミキサ」「荷台形状 の ミキサ」のように解析結果が同じ言い回しは同じキャッシュに当てる
+    return parse_preprocessed(preprocess_question(user_text))
 
+@lru_cache(maxsize=512)
+def parse_preprocessed(user_text: str):
     filter_dict, target_col = parse_conditions(user_text)
-    filtered_df = apply_filters(df, filter_dict)
+    # 言い回しが違っても解析結果 (条件と列) が同じなら同じ回答になる
+    return tuple(sorted(filter_dict.items())), target_col
+
+# df は起動後に変化しないので、同じ条件への回答は使い回せる
+@lru_cache(maxsize=512)
+def answer_conditions(filters: tuple, target_col: str):
+    """(列, (演算子, 値)) のタプル列と集計列から回答を作る。"""
+    filter_dict = dict(filters)
 
     # フィルタ0個: target_colがあれば全データのグラフ
     if len(filter_dict) == 0:
-        if target_col in df.columns:
-            msg, chart = get_distribution_and_chart(df, target_col)
-            return jsonify({"answer": "（列条件なし）\n" + msg, "image": chart})
+        if target_col in FULL_DISTRIBUTIONS:
+            msg, chart_data = FULL_DISTRIBUTIONS[target_col]
+            return "（列条件なし）\n" + msg, chart_data
         else:
             # どの列にも該当しない→ガイド
-            return jsonify({
-                "answer": "列を認識できませんでした。\n" + get_guide_message(),
-                "image": None
-            })
+            return "列を認識できませんでした。\n" + get_guide_message(), None
+
+    filtered_df = apply_filters(df, filter_dict)
 
     # フィルタ後0件
     if len(filtered_df) == 0:
-        return jsonify({
-            "answer": "条件に合うデータがありませんでした。\n" + get_guide_message(),
-            "image": None
-        })
+        return "条件に合うデータがありませんでした。\n" + get_guide_message(), None
 
     # ターゲット列が実在しない
     if target_col not in df.columns:
-        return jsonify({
-            "answer": "グラフ化する列がわかりませんでした。\n" + get_guide_message(),
-            "image": None
-        })
+        return "グラフ化する列がわかりませんでした。\n" + get_guide_message(), None
+
+    return get_distribution(filtered_df, target_col)
+
+@lru_cache(maxsize=512)
+def chart_for_conditions(filters: tuple, target_col: str):
+    """条件に対応するグラフ画像 (WebP バイト列 or None)。全データのグラフは起動時の描画を返す。"""
+    if not filters:
+        return FULL_CHARTS.get(target_col)
+    _, chart_data = answer_conditions(filters, target_col)
+    return render_chart(*chart_data) if chart_data else None
+
+def answer_payload(user_text: str) -> dict:
+    """/ask の JSON 1件分を作る。"""
+    answer, chart_data = answer_question(user_text)
+    # 画像は JSON に埋め込まず URL だけ返し、ブラウザに直接取得・キャッシュさせる
+    image_url = url_for("chart", q=user_text) if chart_data else None
+    return {"answer": answer, "image_url": image_url}
+
+@app.route("/ask", methods=["POST"])
+def ask():
+    data = request.json
+    user_text = data.get("question", "").strip()
+    return jsonify(answer_payload(user_text))
+
+# /ask_batch 1回で受け付ける質問数の上限
+ASK_BATCH_MAX = 20
 
-    msg, chart = get_distribution_and_chart(filtered_df, target_col)
-    return jsonify({"answer": msg, "image": chart})
+@app.route("/ask_batch", methods=["POST"])
+def ask_batch():
+    """
+    {"questions": [...]} をまとめて受け付け、/ask と同じ形式の回答を順に返す。
+    ダッシュボード等で複数列を一度に問い合わせる際の往復回数を減らす。
+    """
+    data = request.get_json(silent=True)
+    questions = data.get("questions") if isinstance(data, dict) else None
+    # 文字列のリストだけを受け付け、1回で描画待ちが積み上がらないよう件数も制限する
+    if (not isinstance(questions, list)
+            or not all(isinstance(q, str) for q in questions)
+            or len(questions) > ASK_BATCH_MAX):
+        abort(400)
+    return jsonify({"answers": [answer_payload(q.strip()) for q in questions]})
+
+@app.route("/chart")
+def chart():
+    """質問文 q に対応するグラフ画像 (WebP) を返す。df は不変なので同じ URL は同じ画像。"""
+    user_text = request.args.get("q", "").strip()
+    chart_bytes = chart_for_conditions(*question_conditions(user_text)) if user_text else None
+    if chart_bytes is None:
+        abort(404)
+    resp = Response(chart_bytes, mimetype="image/webp")
+    resp.headers["Cache-Control"] = "public, max-age=3600"
+    return resp
 
 
 ##################
 # 10) チャット画面
 ##################
-@app.route("/chat")
-def chat():
-    """
-    - 初回ロード時にガイドを自動送信する例
-    """
-    return """
+# ページ内容は起動後に変わらない (ガイドも df.columns 固定) ので起動時に1回だけ組み立てる
+CHAT_HTML = """
 <!DOCTYPE html>
 <html lang="ja">
 <head>
@@ -391,7 +496,7 @@ def chat():
       messages.push({
         role: "assistant",
         content: welcome,
-        image: null
+        image_url: null
       });
       renderMessages();
     }
@@ -407,8 +512,8 @@ def chat():
             </div>`;
         } else {
           let imageTag = "";
-          if (msg.image) {
-            imageTag = '<img src="data:image/png;base64,' + msg.image + '" alt="chart" onclick="enlargeImage(this)" />';
+          if (msg.image_url) {
+            imageTag = '<img src="' + msg.image_url + '" alt="chart" onclick="enlargeImage(this)" />';
           }
           let contentHtml = (msg.content || "").replace(/\\n/g, "<br/>");
           chatArea.innerHTML += `
@@ -440,7 +545,7 @@ def chat():
       messages.push({
         role: "assistant",
         content: data.answer || "(no response)",
-        image: data.image
+        image_url: data.image_url
       });
       renderMessages();
     }
@@ -458,6 +563,19 @@ def chat():
 </body>
 </html>
 """
+# エンコード済みバイト列と ETag も1回だけ作る (内容が同じなら 304 で本文を省略できる)
+CHAT_HTML_BYTES = CHAT_HTML.encode("utf-8")
+CHAT_ETAG = hashlib.md5(CHAT_HTML_BYTES).hexdigest()
+
+@app.route("/chat")
+def chat():
+    """
+    - 初回ロード時にガイドを自動送信する例
+    """
+    resp = Response(CHAT_HTML_BYTES, mimetype="text/html")
+    resp.set_etag(CHAT_ETAG)
+    return resp.make_conditional(request)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # 本番は gunicorn (gunicorn.conf.py) で起動する。ローカルでデバッガを使う時だけ FLASK_DEBUG=1
+    app.run(host="0.0.0.0", port=5000, debug=os.environ.get("FLASK_DEBUG") == "1")
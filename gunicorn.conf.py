@@ -0,0 +1,12 @@
+# Gunicorn 設定 (カレントディレクトリの gunicorn.conf.py は `gunicorn app:app` で自動的に読み込まれる)
+import os
+
+# CSV 読み込みと全列グラフの事前描画 (app.py の import 時処理) を fork 前に1回だけ行い、
+# ワーカーはそのメモリを copy-on-write で共有する
+preload_app = True
+
+# プロセス x スレッドで並行処理する。グラフ描画はワーカー内で CHART_LOCK により直列化されるが、
+# キャッシュ済みの回答やグラフ配信はその間も他スレッドで返せる
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))